@@ -8,22 +8,37 @@ code2docx -- Darcula-themed code export to DOCX
 - After files: "Screenshots:" with images in 2-column layout, then "Done."
 """
 
+import fnmatch
 import os
+import re
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache
+from itertools import islice
+from io import BytesIO
+from zipfile import ZIP_STORED
+from lxml.etree import SubElement
 from docx import Document
 from docx.shared import Pt, RGBColor, Inches
 from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.opc import phys_pkg, pkgwriter
 from pygments import lex
+from pygments.token import string_to_tokentype
 from pygments.util import ClassNotFound
-from pygments.lexers import guess_lexer_for_filename, TextLexer
 
 OUTPUT_NAME = "project_files.docx"
 
 # Image extensions to look for
 IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.tif', '.webp'}
+_IMG_SUFFIXES = tuple(sorted(IMAGE_EXTENSIONS))
+
+# Package members that are already compressed; deflating them again only costs CPU
+STORED_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif')
 
 # Darcula-inspired token color map (hex strings)
 TOKEN_COLOR_MAP = {
@@ -39,11 +54,40 @@ TOKEN_COLOR_MAP = {
     "Name": "a9b7c6",
     "Text": "a9b7c6",
     "Error": "ff0000",
+    "Generic.Error": "ff0000",
     "Literal": "6a8759",
 }
 
 CODE_BG_HEX = "2b2b2b"
 IMAGE_WIDTH_INCHES = 3.0
+# Embedded screenshot width in pixels (~150 dpi at IMAGE_WIDTH_INCHES)
+IMAGE_TARGET_PX = int(IMAGE_WIDTH_INCHES * 150)
+JPEG_QUALITY = 82
+
+# Bytes sniffed for NUL to tell text from binary, and read size thereafter
+TEXT_PROBE_SIZE = 4096
+READ_CHUNK_SIZE = 1 << 20
+# Characters of content given to Pygments when guessing a lexer
+LEXER_SAMPLE_SIZE = 4096
+
+# Namespace-qualified tags used when building code paragraphs directly
+W_R = qn('w:r')
+W_RFONTS = qn('w:rFonts')
+W_COLOR = qn('w:color')
+W_SZ = qn('w:sz')
+W_T = qn('w:t')
+W_SHD = qn('w:shd')
+W_SECTPR = qn('w:sectPr')
+W_VAL = qn('w:val')
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+# Resolved lexer classes, keyed by file extension, or by the whole name for
+# files a lexer claims by name (e.g. "Makefile", "CMakeLists.txt").
+# Like Pygments' own filename matching, keys are case-sensitive.
+_LEXER_CACHE = {}
+
+# Lexer filename patterns that are plain "*.ext" globs
+_EXT_PATTERN = re.compile(r'^\*\.[^.*?\[\]]+$')
 
 
 def hex_to_rgb(hexstr):
@@ -54,27 +98,40 @@ def hex_to_rgb(hexstr):
     return RGBColor(r, g, b)
 
 
+# TOKEN_COLOR_MAP resolved to Pygments token types. Each distinct hex gets a
+# single RGBColor, so merge_runs() can compare colors by identity.
+_RGB_BY_HEX = {hexstr: hex_to_rgb(hexstr) for hexstr in set(TOKEN_COLOR_MAP.values())}
+_TOK2RGB = {
+    string_to_tokentype("Token." + name): _RGB_BY_HEX[hexstr]
+    for name, hexstr in TOKEN_COLOR_MAP.items()
+}
+_DEFAULT_RGB = _TOK2RGB[string_to_tokentype("Token.Text")]
+
+
 def token_color(tok_type):
-    s = str(tok_type)
-    for key in ("Name.Function", "Name.Class", "Name.Builtin"):
-        if key in s and key in TOKEN_COLOR_MAP:
-            return hex_to_rgb(TOKEN_COLOR_MAP[key])
-    for key in TOKEN_COLOR_MAP:
-        if key in s:
-            return hex_to_rgb(TOKEN_COLOR_MAP[key])
-    return hex_to_rgb(TOKEN_COLOR_MAP["Text"])
+    # Walk up the token hierarchy (e.g. Name.Function.Magic -> Name.Function)
+    while tok_type is not None:
+        rgb = _TOK2RGB.get(tok_type)
+        if rgb is not None:
+            return rgb
+        tok_type = tok_type.parent
+    return _DEFAULT_RGB
+
+
+_SHD_TEMPLATE = OxmlElement('w:shd')
+_SHD_TEMPLATE.set(qn('w:val'), 'clear')
+_SHD_TEMPLATE.set(qn('w:color'), 'auto')
+_SHD_TEMPLATE.set(qn('w:fill'), CODE_BG_HEX)
 
 
 def set_paragraph_shading(paragraph, fill_color):
-    p = paragraph._p
-    pPr = p.get_or_add_pPr()
-    existing = pPr.find(qn('w:shd'))
+    pPr = paragraph._p.get_or_add_pPr()
+    existing = pPr.find(W_SHD)
     if existing is not None:
         pPr.remove(existing)
-    shd = OxmlElement('w:shd')
-    shd.set(qn('w:val'), 'clear')
-    shd.set(qn('w:color'), 'auto')
-    shd.set(qn('w:fill'), fill_color)
+    shd = deepcopy(_SHD_TEMPLATE)
+    if fill_color != CODE_BG_HEX:
+        shd.set(qn('w:fill'), fill_color)
     pPr.append(shd)
 
 
@@ -87,65 +144,210 @@ def add_filename(doc, filename):
     run.font.bold = True
 
 
-def add_colored_code_block(doc, code_text, filename_hint):
+# The lexer registry and Pillow are imported on first use: together they
+# are a large share of startup time and not every run needs them.
+@lru_cache(maxsize=None)
+def _lexer_api():
+    from pygments.lexers import TextLexer
     try:
-        lexer = guess_lexer_for_filename(filename_hint, code_text)
-    except (ClassNotFound, Exception):
-        lexer = TextLexer()
-
-    tokens = list(lex(code_text, lexer))
-    lines = [[]]
-    
-    for tok_type, value in tokens:
-        value = value.replace("\t", " " * 4)
-        parts = value.splitlines(keepends=True)
-        for part in parts:
-            if part.endswith("\n") or part.endswith("\r\n"):
-                text_part = part.rstrip("\r\n")
-                if text_part:
-                    lines[-1].append((tok_type, text_part))
-                lines.append([])
-            else:
-                if part:
-                    lines[-1].append((tok_type, part))
-    
-    if len(lines) > 1 and lines[-1] == []:
-        lines.pop()
-
-    for line_tokens in lines or [[]]:
-        p = doc.add_paragraph()
-        set_paragraph_shading(p, CODE_BG_HEX)
-
-        if not line_tokens:
-            r = p.add_run(" ")
-            r.font.name = "Courier New"
-            r._element.rPr.rFonts.set(qn('w:eastAsia'), 'Courier New')
-            r.font.size = Pt(10)
-            r.font.color.rgb = hex_to_rgb(TOKEN_COLOR_MAP["Text"])
-            continue
-
-        for tok_type, txt in line_tokens:
-            run = p.add_run(txt)
-            run.font.name = "Courier New"
-            run._element.rPr.rFonts.set(qn('w:eastAsia'), 'Courier New')
-            run.font.size = Pt(10)
-            run.font.color.rgb = token_color(tok_type)
-
-
-def is_text_file(path, blocksize=1024):
+        # pygments-cache keeps lexer discovery out of the per-file cost
+        from pygments_cache import get_lexer_for_filename, guess_lexer_for_filename
+    except ImportError:
+        from pygments.lexers import get_lexer_for_filename, guess_lexer_for_filename
+    return get_lexer_for_filename, guess_lexer_for_filename, TextLexer
+
+
+@lru_cache(maxsize=None)
+def _name_patterns():
+    """Regex matching any lexer filename pattern that is not a plain "*.ext".
+
+    Names it matches can't share a cache entry with their extension.
+    """
+    from pygments.lexers import get_all_lexers
+    patterns = {
+        pattern
+        for _, _, filenames, _ in get_all_lexers()
+        for pattern in filenames
+        if not _EXT_PATTERN.match(pattern)
+    }
+    return re.compile('|'.join(fnmatch.translate(p) for p in sorted(patterns)))
+
+
+@lru_cache(maxsize=None)
+def _pil_image():
     try:
-        with open(path, "rb") as f:
-            chunk = f.read(blocksize)
-            if b'\x00' in chunk:
-                return False
-    except Exception:
-        return False
-    return True
-
-
-def is_image_file(filename):
-    ext = os.path.splitext(filename)[1].lower()
-    return ext in IMAGE_EXTENSIONS
+        # Optional: used to downscale screenshots before embedding
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def get_lexer(code_text, filename_hint):
+    basename = os.path.basename(filename_hint)
+    ext = os.path.splitext(basename)[1]
+    key = basename if not ext or _name_patterns().match(basename) else ext
+    lexer_cls = _LEXER_CACHE.get(key)
+    if lexer_cls is None:
+        get_lexer_for_filename, guess_lexer, TextLexer = _lexer_api()
+        try:
+            # Extension lookup alone is enough for most files; only fall back
+            # to content analysis (on a bounded sample) when it finds nothing.
+            lexer_cls = type(get_lexer_for_filename(filename_hint))
+        except ClassNotFound:
+            try:
+                lexer_cls = type(guess_lexer(filename_hint, code_text[:LEXER_SAMPLE_SIZE]))
+            except (ClassNotFound, Exception):
+                lexer_cls = TextLexer
+        except Exception:
+            lexer_cls = TextLexer
+        _LEXER_CACHE[key] = lexer_cls
+    return lexer_cls()
+
+
+def _build_code_ppr():
+    pPr = OxmlElement('w:pPr')
+    pPr.append(deepcopy(_SHD_TEMPLATE))
+    return pPr
+
+
+def _build_code_rpr():
+    rPr = OxmlElement('w:rPr')
+    rFonts = SubElement(rPr, W_RFONTS)
+    rFonts.set(qn('w:ascii'), 'Courier New')
+    rFonts.set(qn('w:hAnsi'), 'Courier New')
+    rFonts.set(qn('w:eastAsia'), 'Courier New')
+    SubElement(rPr, W_COLOR).set(W_VAL, TOKEN_COLOR_MAP["Text"])
+    SubElement(rPr, W_SZ).set(W_VAL, '20')
+    return rPr
+
+
+_CODE_PPR = _build_code_ppr()
+_CODE_RPR = _build_code_rpr()
+_EMPTY_P = OxmlElement('w:p')
+
+
+def _has_trailing_sectPr(body):
+    # sectPr, when present, is the body's last child; checking from the end
+    # avoids scanning every paragraph added so far.
+    last = next(body.iterchildren(reversed=True), None)
+    return last is not None and last.tag == W_SECTPR
+
+
+def append_body_element(doc, element):
+    """Add a block element to the document body, keeping sectPr last."""
+    append_body_elements(doc, [element])
+
+
+def append_body_elements(doc, elements):
+    """Add block elements to the document body in one tree mutation."""
+    body = doc.element.body
+    if _has_trailing_sectPr(body):
+        body[-1:-1] = elements
+    else:
+        body.extend(elements)
+
+
+def add_blank_paragraph(doc):
+    append_body_element(doc, deepcopy(_EMPTY_P))
+
+
+def code_paragraph(runs):
+    """Build a shaded code <w:p> from (color, text) runs, bypassing python-docx objects."""
+    p = OxmlElement('w:p')
+    p.append(deepcopy(_CODE_PPR))
+    for color, txt in runs:
+        r = SubElement(p, W_R)
+        rPr = deepcopy(_CODE_RPR)
+        rPr.find(W_COLOR).set(W_VAL, str(color))
+        r.append(rPr)
+        t = SubElement(r, W_T)
+        t.set(XML_SPACE, 'preserve')
+        t.text = txt
+    return p
+
+
+def merge_runs(line_tokens):
+    """Collapse adjacent tokens sharing a color into (color, text) runs."""
+    runs = []
+    cur_color = None
+    buf = []
+    for tok_type, txt in line_tokens:
+        color = token_color(tok_type)
+        if color is not cur_color and buf:
+            runs.append((cur_color, "".join(buf)))
+            buf = []
+        cur_color = color
+        buf.append(txt)
+    if buf:
+        runs.append((cur_color, "".join(buf)))
+    return runs
+
+
+def code_lines(code_text, filename_hint):
+    """Lex code_text into a list of lines, each a list of (color, text) runs.
+
+    Touches no docx objects, so it is safe to call from worker threads.
+    """
+    lexer = get_lexer(code_text, filename_hint)
+
+    # Single pass over the token stream, closing a line at each newline
+    lines = []
+    line_tokens = []
+    for tok_type, value in lex(code_text, lexer):
+        # Pygments has already normalized line endings to "\n"; every part
+        # but the last ends a line, the last continues the current one.
+        parts = value.replace("\t", " " * 4).split("\n")
+        last = len(parts) - 1
+        for i, part in enumerate(parts):
+            if part:
+                line_tokens.append((tok_type, part))
+            if i < last:
+                lines.append(merge_runs(line_tokens))
+                line_tokens.clear()
+
+    if line_tokens or not lines:
+        lines.append(merge_runs(line_tokens))
+    return lines
+
+
+def add_code_lines(doc, lines):
+    # Build the whole block detached, then attach it to the body at once
+    paragraphs = [code_paragraph(runs or [(_DEFAULT_RGB, " ")]) for runs in lines]
+    append_body_elements(doc, paragraphs)
+
+
+def read_text_file(path, blocksize=TEXT_PROBE_SIZE):
+    """Return the decoded contents of path, or None if it looks binary.
+
+    Probes and reads through a single descriptor, so each file is opened once.
+    Any NUL byte means binary: besides real binaries this catches UTF-16 text,
+    which could not be decoded as UTF-8 or put into the XML anyway.
+    """
+    # O_BINARY (Windows only) stops the CRT from translating CRLF and
+    # treating Ctrl-Z as end of file
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        chunk = os.read(fd, blocksize)
+        if not chunk:
+            return ""
+        if b'\x00' in chunk:
+            return None
+        chunks = [chunk]
+        while chunk:
+            chunk = os.read(fd, READ_CHUNK_SIZE)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    data = b"".join(chunks)
+    if b'\x00' in data:
+        return None
+    return data.decode('utf-8', errors='replace')
+
+
+def is_image_file(lower_name):
+    """Check an already-lowercased file name against the image extensions."""
+    return lower_name.endswith(_IMG_SUFFIXES)
 
 
 def remove_table_borders(table):
@@ -167,19 +369,99 @@ def remove_table_borders(table):
         tbl.insert(0, tblPr)
 
 
-def add_screenshots_section(doc, cwd):
-    image_files = []
-    entries = sorted(os.listdir(cwd))
-    
-    for name in entries:
+def prepare_file(path, name):
+    """Read and lex one input file, returning a (kind, payload) pair.
+
+    kind is "code" (payload: code_lines() output), "plain" (payload: raw
+    text that failed to highlight), "unreadable" (payload: error text) or
+    "binary" (payload: None).
+    """
+    try:
+        content = read_text_file(path)
+    except Exception as e:
+        return "unreadable", f"<Could not read file: {e}>"
+    if content is None:
+        return "binary", None
+    try:
+        return "code", code_lines(content, name)
+    except Exception:
+        return "plain", content
+
+
+def prepared_files(executor, entries, max_pending):
+    """Yield (entry, prepare_file() result) in order.
+
+    At most max_pending files are queued or finished ahead of the consumer,
+    and each result is released once yielded, so peak memory stays bounded
+    by a few files rather than the whole folder.
+    """
+    def submit(entry):
+        return entry, executor.submit(prepare_file, entry.path, entry.name)
+
+    entries = iter(entries)
+    pending = deque(submit(entry) for entry in islice(entries, max_pending))
+    while pending:
+        entry, future = pending.popleft()
+        result = future.result()
+        del future
+        next_entry = next(entries, None)
+        if next_entry is not None:
+            pending.append(submit(next_entry))
+        yield entry, result
+
+
+def scan_folder(cwd):
+    """List cwd once, returning sorted (code_entries, image_entries) DirEntry lists."""
+    with os.scandir(cwd) as it:
+        entries = sorted(it, key=lambda e: e.name)
+
+    code_entries = []
+    image_entries = []
+    for entry in entries:
+        name = entry.name
         if name.startswith('.'):
             continue
-        if name.lower().endswith('.docx'):
+        lower = name.lower()
+        if lower.endswith('.docx'):
             continue
-        path = os.path.join(cwd, name)
-        if os.path.isfile(path) and is_image_file(name):
-            image_files.append((name, path))
-    
+        if not entry.is_file():
+            continue
+        if is_image_file(lower):
+            image_entries.append(entry)
+        else:
+            code_entries.append(entry)
+    return code_entries, image_entries
+
+
+def prepare_image(path, target_px=IMAGE_TARGET_PX):
+    """Return something add_picture() accepts: a downscaled, re-encoded
+    BytesIO when Pillow is available and the image is wider than needed,
+    otherwise the original path.
+    """
+    Image = _pil_image()
+    if Image is None:
+        return path
+    try:
+        with Image.open(path) as im:
+            if im.width <= target_px or getattr(im, "is_animated", False):
+                return path
+            fmt = 'JPEG' if im.format == 'JPEG' else 'PNG'
+            im.thumbnail((target_px, target_px * 10), Image.LANCZOS)
+            if fmt == 'JPEG' and im.mode != 'RGB':
+                im = im.convert('RGB')
+            elif fmt == 'PNG' and im.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                im = im.convert('RGBA')
+            buf = BytesIO()
+            im.save(buf, fmt, quality=JPEG_QUALITY, optimize=True)
+    except Exception:
+        # Let add_picture() report the problem with the original file
+        return path
+    buf.seek(0)
+    return buf
+
+
+def add_screenshots_section(doc, image_entries):
+    image_files = [(entry.name, entry.path) for entry in image_entries]
     if not image_files:
         doc.add_paragraph("No screenshots found in folder.")
         return
@@ -189,16 +471,21 @@ def add_screenshots_section(doc, cwd):
     table.alignment = WD_TABLE_ALIGNMENT.CENTER
     remove_table_borders(table)
     
-    for idx, (name, path) in enumerate(image_files):
-        row_idx = idx // 2
-        col_idx = idx % 2
-        cell = table.rows[row_idx].cells[col_idx]
+    # Decode/resize in parallel (Pillow releases the GIL); map keeps order
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        pictures = list(executor.map(prepare_image, [path for _, path in image_files]))
+
+    # Resolve the cell grid once; .rows/.cells rebuild their lists per access
+    cells_grid = [row.cells for row in table.rows]
+
+    for idx, ((name, _), picture) in enumerate(zip(image_files, pictures)):
+        cell = cells_grid[idx // 2][idx % 2]
         paragraph = cell.paragraphs[0]
         paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
         
         try:
             run = paragraph.add_run()
-            run.add_picture(path, width=Inches(IMAGE_WIDTH_INCHES))
+            run.add_picture(picture, width=Inches(IMAGE_WIDTH_INCHES))
             caption_para = cell.add_paragraph()
             caption_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
             caption_run = caption_para.add_run(name)
@@ -210,16 +497,40 @@ def add_screenshots_section(doc, cwd):
             error_run.font.size = Pt(9)
             error_run.font.color.rgb = RGBColor(255, 0, 0)
     
-    doc.add_paragraph()
+    add_blank_paragraph(doc)
+
+
+class _MediaStoringZipPkgWriter(phys_pkg._ZipPkgWriter):
+    """python-docx's zip writer, but storing compressed images uncompressed."""
+
+    def __new__(cls, pkg_file):
+        # PhysPkgWriter.__new__ would always hand back a plain _ZipPkgWriter
+        return object.__new__(cls)
+
+    def write(self, pack_uri, blob):
+        membername = pack_uri.membername
+        if membername.lower().endswith(STORED_SUFFIXES):
+            self._zipf.writestr(membername, blob, compress_type=ZIP_STORED)
+        else:
+            super().write(pack_uri, blob)
+
+
+def save_document(doc, path):
+    # PackageWriter looks PhysPkgWriter up at save time; swap it just for this call
+    original = pkgwriter.PhysPkgWriter
+    pkgwriter.PhysPkgWriter = _MediaStoringZipPkgWriter
+    try:
+        doc.save(path)
+    finally:
+        pkgwriter.PhysPkgWriter = original
 
 
 def main():
-    # Use current working directory (where command is run)
-    cwd = os.getcwd()
-    
-    # Optional: accept path as argument
-    if len(sys.argv) > 1:
-        cwd = os.path.abspath(sys.argv[1])
+    # Optional path argument, else the current working directory
+    # (where command is run); only relative paths need resolving
+    cwd = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+    if not os.path.isabs(cwd):
+        cwd = os.path.abspath(cwd)
     
     if not os.path.isdir(cwd):
         print(f"Error: '{cwd}' is not a valid directory")
@@ -228,48 +539,35 @@ def main():
     print(f"Processing folder: {cwd}")
     doc = Document()
 
-    entries = sorted(os.listdir(cwd))
+    code_entries, image_entries = scan_folder(cwd)
     any_files = False
 
-    for name in entries:
-        if name.startswith('.'):
-            continue
-        if name.lower().endswith('.docx'):
-            continue
-        if is_image_file(name):
-            continue
-
-        path = os.path.join(cwd, name)
-        if not os.path.isfile(path):
-            continue
-
-        any_files = True
-        print(f"  Adding: {name}")
-        add_filename(doc, name)
-
-        if is_text_file(path):
-            try:
-                with open(path, 'r', encoding='utf-8', errors='replace') as f:
-                    content = f.read()
-            except Exception as e:
-                content = f"<Could not read file: {e}>"
-                doc.add_paragraph(content)
-                continue
-
-            try:
-                add_colored_code_block(doc, content, name)
-            except Exception:
+    # Read and lex files in parallel; docx assembly stays on this thread
+    workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry, (kind, payload) in prepared_files(executor, code_entries, 2 * workers):
+            name = entry.name
+            any_files = True
+            print(f"  Adding: {name}")
+            add_filename(doc, name)
+
+            if kind == "code":
+                add_code_lines(doc, payload)
+            elif kind == "plain":
                 p = doc.add_paragraph()
                 set_paragraph_shading(p, CODE_BG_HEX)
-                run = p.add_run(content)
+                run = p.add_run(payload)
                 run.font.name = "Courier New"
                 run._element.rPr.rFonts.set(qn('w:eastAsia'), 'Courier New')
                 run.font.size = Pt(10)
                 run.font.color.rgb = hex_to_rgb(TOKEN_COLOR_MAP["Text"])
-        else:
-            doc.add_paragraph("<Binary or non-text file - skipped>")
+            elif kind == "unreadable":
+                doc.add_paragraph(payload)
+                continue
+            else:
+                doc.add_paragraph("<Binary or non-text file - skipped>")
 
-        doc.add_paragraph()
+            add_blank_paragraph(doc)
 
     if not any_files:
         doc.add_paragraph("No code files found in this folder.")
@@ -281,12 +579,12 @@ def main():
     run.font.size = Pt(14)
     run.font.bold = True
     
-    doc.add_paragraph()
-    add_screenshots_section(doc, cwd)
+    add_blank_paragraph(doc)
+    add_screenshots_section(doc, image_entries)
     doc.add_paragraph("Done.")
 
     out_path = os.path.join(cwd, OUTPUT_NAME)
-    doc.save(out_path)
+    save_document(doc, out_path)
     print(f"\n✓ Saved: {out_path}")
 
 